@@ -108,6 +108,41 @@ def export_onnx(model, im, file, opset, train, dynamic, simplify, prefix=colorst
         LOGGER.info(f'{prefix} export failure: {e}')
 
 
+def export_onnx_int8(model, im, file, data, ncalib, prefix=colorstr('ONNX INT8:')):
+    # ONNX Runtime static INT8 quantization of the backbone Convs, for CPUExecutionProvider inference
+    try:
+        check_requirements(('onnx', 'onnxruntime'))
+        import onnx
+        import onnxruntime
+        from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+        LOGGER.info(f'\n{prefix} starting export with onnxruntime {onnxruntime.__version__}...')
+        batch_size, ch, *imgsz = list(im.shape)  # BCHW
+        f_onnx = file.with_suffix('.onnx')
+        f = str(file).replace('.pt', '-int8.onnx')
+
+        class DataReader(CalibrationDataReader):
+            # Calibration images, letterboxed and normalized as at inference
+            def __init__(self):
+                dataset = LoadImages(check_dataset(data)['train'], img_size=imgsz, auto=False)
+                self.images = (img for _, (path, img, im0s, vid_cap, s) in zip(range(ncalib), dataset))
+
+            def get_next(self):
+                img = next(self.images, None)
+                return None if img is None else {'images': img[None].astype('float32') / 255}
+
+        # Keep the Detect head in float, its outputs mix pixel xywh with 0-1 confidences under one scale
+        convs = [n.name for n in onnx.load(f_onnx).graph.node if n.op_type == 'Conv']
+        head = convs[-model.model[-1].nl:]  # Detect.m Convs run last
+
+        quantize_static(f_onnx, f, DataReader(), quant_format=QuantFormat.QDQ, op_types_to_quantize=['Conv'],
+                        nodes_to_exclude=head, activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+        LOGGER.info(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+        LOGGER.info(f"{prefix} compare accuracy against FP32 with 'python val.py --weights {f}' before deploying")
+    except Exception as e:
+        LOGGER.info(f'\n{prefix} export failure: {e}')
+
+
 def export_coreml(model, im, file, prefix=colorstr('CoreML:')):
     #  CoreML export
     ct_model = None
@@ -262,7 +297,7 @@ def run(data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
         inplace=False,  # set  Detect() inplace=True
         train=False,  # model.train() mode
         optimize=False,  # TorchScript: optimize for mobile
-        int8=False,  # CoreML/TF INT8 quantization
+        int8=False,  # CoreML/TF/ONNX INT8 quantization
         dynamic=False,  # ONNX/TF: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset=12,  # ONNX: opset version
@@ -310,6 +345,10 @@ def run(data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
         export_torchscript(model, im, file, optimize)
     if 'onnx' in include:
         export_onnx(model, im, file, opset, train, dynamic, simplify)
+        if int8 and not half:
+            export_onnx_int8(model, im, file, data, ncalib=100)
+        elif int8:
+            LOGGER.info(f"\n{colorstr('ONNX INT8:')} skipped, quantization requires an FP32 export without --half")
     if 'coreml' in include:
         export_coreml(model, im, file)
 
@@ -344,7 +383,7 @@ def parse_opt():
     parser.add_argument('--inplace', action='store_true', help='set YOLOv3 Detect() inplace=True')
     parser.add_argument('--train', action='store_true', help='model.train() mode')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
-    parser.add_argument('--int8', action='store_true', help='CoreML/TF INT8 quantization')
+    parser.add_argument('--int8', action='store_true', help='CoreML/TF/ONNX INT8 quantization')
     parser.add_argument('--dynamic', action='store_true', help='ONNX/TF: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset', type=int, default=13, help='ONNX: opset version')
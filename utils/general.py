@@ -545,11 +545,10 @@ def xyxy2xywh(x):
 
 def xywh2xyxy(x):
     # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
-    y = x.clone() if isinstance(x, torch.Tensor) else np.copy(x)
-    y[:, 0] = x[:, 0] - x[:, 2] / 2  # top left x
-    y[:, 1] = x[:, 1] - x[:, 3] / 2  # top left y
-    y[:, 2] = x[:, 0] + x[:, 2] / 2  # bottom right x
-    y[:, 3] = x[:, 1] + x[:, 3] / 2  # bottom right y
+    y = torch.empty_like(x) if isinstance(x, torch.Tensor) else np.empty_like(x)
+    wh = x[:, 2:4] / 2  # half width, height
+    y[:, :2] = x[:, :2] - wh  # top left xy
+    y[:, 2:] = x[:, :2] + wh  # bottom right xy
     return y
 
 